@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark for the backend.
+
+Measures, over several fresh processes:
+  - import time of the `server` module
+  - time from spawning uvicorn to the first successful readiness check
+
+Needs a reachable MongoDB (MONGO_URL/DB_NAME from backend/.env).
+
+    python bench_startup.py --runs 5
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import requests
+
+ROOT_DIR = Path(__file__).parent
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); import server; "
+    "print(time.perf_counter() - started)"
+)
+
+
+def measure_import_time() -> float:
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT_DIR, text=True)
+    return float(output.strip().splitlines()[-1])
+
+
+def measure_first_request(port: int, timeout: float) -> float:
+    url = f"http://127.0.0.1:{port}/api/health/ready"
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT_DIR,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with code {process.returncode}")
+            try:
+                if requests.get(url, timeout=1).status_code == 200:
+                    return time.perf_counter() - started
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.01)
+        raise TimeoutError(f"No successful response from {url} within {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def summarize(name: str, samples: list):
+    print(
+        f"{name}: min {min(samples) * 1000:.1f}ms  "
+        f"median {statistics.median(samples) * 1000:.1f}ms  "
+        f"max {max(samples) * 1000:.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    import_times = [measure_import_time() for _ in range(args.runs)]
+    first_request_times = [measure_first_request(args.port, args.timeout) for _ in range(args.runs)]
+
+    summarize("import server", import_times)
+    summarize("time to first successful request", first_request_times)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Data access for the backend.
+
+Reads are routed by how much staleness they tolerate:
+
+  - `primary`: auth, swap state changes and anything that must read its
+    own writes;
+  - `discovery`: search, public profiles and dashboard counts, served by
+    the nearest member within `max_staleness_seconds`, each operation
+    bounded by `discovery_max_time_ms`.
+
+Against a standalone server both handles talk to the same node. To try the
+routing locally, start a replica set (e.g. `mongod --replSet rs0` plus
+`rs.initiate()` with a few members) and set
+MONGO_URL="mongodb://localhost:27017,localhost:27018/?replicaSet=rs0".
+tests/test_database.py exercises the routing when MONGO_RS_URL points at
+such a replica set.
+"""
+
+import threading
+from collections import defaultdict
+from typing import Dict
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+from pymongo.read_preferences import Nearest, Primary
+
+
+class PoolWaitMonitor(monitoring.ConnectionPoolListener):
+    """Records how long operations wait to check a connection out of the pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"checkouts": 0, "failed": 0, "total_ms": 0.0, "max_ms": 0.0})
+
+    def _record(self, event, failed=False):
+        # `duration` (seconds) is measured by the driver, from checkout start to end
+        if event.duration is None:
+            return
+        waited_ms = event.duration * 1000
+        with self._lock:
+            stats = self._stats[f"{event.address[0]}:{event.address[1]}"]
+            stats["checkouts"] += 1
+            stats["failed"] += failed
+            stats["total_ms"] += waited_ms
+            stats["max_ms"] = max(stats["max_ms"], waited_ms)
+
+    def connection_checked_out(self, event):
+        self._record(event)
+
+    def connection_check_out_failed(self, event):
+        self._record(event, failed=True)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                address: {
+                    **stats,
+                    "avg_ms": round(stats["total_ms"] / stats["checkouts"], 3) if stats["checkouts"] else 0.0,
+                    "total_ms": round(stats["total_ms"], 3),
+                    "max_ms": round(stats["max_ms"], 3),
+                }
+                for address, stats in self._stats.items()
+            }
+
+
+class DataAccess:
+    def __init__(self, settings):
+        self.pool_monitor = PoolWaitMonitor()
+        self.client = AsyncIOMotorClient(
+            settings.mongo_url,
+            minPoolSize=settings.mongo_min_pool_size,
+            maxPoolSize=settings.mongo_max_pool_size,
+            waitQueueTimeoutMS=settings.mongo_wait_queue_timeout_ms,
+            connectTimeoutMS=settings.mongo_connect_timeout_ms,
+            serverSelectionTimeoutMS=settings.mongo_server_selection_timeout_ms,
+            event_listeners=[self.pool_monitor],
+        )
+        self.primary = self.client.get_database(settings.db_name, read_preference=Primary())
+        self.discovery = self.client.get_database(
+            settings.db_name,
+            read_preference=Nearest(max_staleness=settings.mongo_max_staleness_seconds)
+        )
+        self.discovery_max_time_ms = settings.mongo_discovery_max_time_ms
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,331 @@
+"""
+Online batch migrations for user and swap documents.
+
+Every migrated document carries a `schema_version`. A migration moves one
+collection from version N-1 to N and is described by an `upgrade` function
+returning the fields to `$set`. `upgrade_fields` chains those functions
+from a document's version up to a target, and is used in two places:
+
+  - the runner rewrites stored documents in checkpointed `bulk_write`
+    batches, throttled to a target batch latency. A lease on the
+    migration record keeps concurrent runners from processing it twice;
+  - request handlers call `upgrade_document` on every document they read,
+    so old and new documents look the same while a migration is running.
+
+Run pending migrations with:
+
+    python migrations.py [--dry-run] [--target-latency-ms 200]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+ROOT_DIR = Path(__file__).parent
+
+logger = logging.getLogger(__name__)
+
+# Migration statuses
+RUNNING = "running"
+COMPLETED = "completed"
+
+# Times a batch is re-read and rewritten when documents change under it
+WRITE_RETRIES = 5
+
+
+@dataclass
+class Migration:
+    collection: str
+    version: int
+    name: str
+    upgrade: Callable[[dict], dict]
+
+    @property
+    def key(self) -> str:
+        return f"{self.collection}:{self.version:04d}"
+
+
+# Upgrades
+
+def normalize_skills(skills: List[str]) -> List[str]:
+    """Strip whitespace and drop empty and case-insensitive duplicate skills."""
+    normalized = []
+    seen = set()
+    for skill in skills or []:
+        skill = skill.strip()
+        if skill and skill.lower() not in seen:
+            seen.add(skill.lower())
+            normalized.append(skill)
+    return normalized
+
+
+def add_user_updated_at(doc: dict) -> dict:
+    return {"updated_at": doc.get("updated_at") or doc.get("created_at") or datetime.utcnow()}
+
+
+def normalize_user_skills(doc: dict) -> dict:
+    return {
+        "skills_offered": normalize_skills(doc.get("skills_offered")),
+        "skills_wanted": normalize_skills(doc.get("skills_wanted")),
+    }
+
+
+MIGRATIONS: List[Migration] = [
+    Migration("users", 1, "add updated_at to users", add_user_updated_at),
+    Migration("users", 2, "normalize user skills", normalize_user_skills),
+]
+
+
+def current_schema_version(collection: str) -> int:
+    return max((m.version for m in MIGRATIONS if m.collection == collection), default=0)
+
+
+def upgrade_fields(collection: str, doc: dict, target_version: int) -> dict:
+    """
+    Fields to `$set` to bring `doc` from its schema_version up to
+    `target_version`, applying every intermediate upgrade in order.
+    """
+    upgraded = dict(doc)
+    fields = {}
+    for migration in MIGRATIONS:
+        if migration.collection == collection and upgraded.get("schema_version", 0) < migration.version <= target_version:
+            changes = migration.upgrade(upgraded)
+            changes["schema_version"] = migration.version
+            upgraded.update(changes)
+            fields.update(changes)
+    return fields
+
+
+def upgrade_document(collection: str, doc: Optional[dict]) -> Optional[dict]:
+    """Bring a document read from `collection` up to the current schema in memory."""
+    if doc is None:
+        return None
+    doc.update(upgrade_fields(collection, doc, current_schema_version(collection)))
+    return doc
+
+
+# Throttling
+
+class AdaptiveThrottle:
+    """
+    Sizes batches so a bulk write takes roughly `target_seconds`.
+
+    Batch latency is the load signal: when a write is slower than the target
+    the batch is halved and the pause between batches grows, otherwise the
+    batch grows additively and the pause decays.
+    """
+
+    def __init__(self, target_seconds: float, batch_size: int = 100, min_batch_size: int = 10,
+                 max_batch_size: int = 1000, max_pause_seconds: float = 5.0):
+        self.target_seconds = target_seconds
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_pause_seconds = max_pause_seconds
+        self.pause_seconds = 0.0
+
+    def record(self, elapsed: float):
+        if elapsed > self.target_seconds:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            self.pause_seconds = min(self.max_pause_seconds, max(self.pause_seconds * 2, elapsed))
+        else:
+            self.batch_size = min(self.max_batch_size, self.batch_size + self.min_batch_size)
+            self.pause_seconds /= 2
+
+    async def wait(self):
+        if self.pause_seconds:
+            await asyncio.sleep(self.pause_seconds)
+
+
+# Runner
+
+class MigrationRunner:
+    def __init__(self, db: AsyncIOMotorDatabase, throttle: AdaptiveThrottle, dry_run: bool = False,
+                 lease_seconds: int = 60):
+        self.db = db
+        self.throttle = throttle
+        self.dry_run = dry_run
+        self.lease_seconds = lease_seconds
+        self.runner_id = str(uuid.uuid4())
+
+    async def pending(self) -> List[Migration]:
+        completed = await self.db.migrations.distinct("_id", {"status": COMPLETED})
+        return sorted(
+            (m for m in MIGRATIONS if m.key not in completed),
+            key=lambda m: (m.collection, m.version)
+        )
+
+    async def run_all(self) -> bool:
+        """Run pending migrations in order. Returns False if one of them could not finish."""
+        for migration in await self.pending():
+            if not await self.run(migration):
+                return False
+        return True
+
+    async def acquire(self, migration: Migration) -> Optional[dict]:
+        """Create or take over the migration record; None if another runner holds its lease."""
+        now = datetime.utcnow()
+        try:
+            return await self.db.migrations.find_one_and_update(
+                {
+                    "_id": migration.key,
+                    "status": {"$ne": COMPLETED},
+                    "$or": [
+                        {"lease_owner": self.runner_id},
+                        {"lease_expires_at": {"$not": {"$gte": now}}},
+                    ],
+                },
+                {
+                    "$set": {
+                        "lease_owner": self.runner_id,
+                        "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+                    },
+                    "$setOnInsert": {
+                        "name": migration.name,
+                        "collection": migration.collection,
+                        "version": migration.version,
+                        "status": RUNNING,
+                        "last_id": None,
+                        "processed": 0,
+                        "started_at": now,
+                    },
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # The record exists but is completed or leased by another runner
+            return None
+
+    async def checkpoint(self, migration: Migration, fields: dict) -> bool:
+        """Save progress and renew the lease. Returns False if the lease was lost."""
+        result = await self.db.migrations.update_one(
+            {"_id": migration.key, "lease_owner": self.runner_id},
+            {"$set": {**fields, "lease_expires_at": datetime.utcnow() + timedelta(seconds=self.lease_seconds)}}
+        )
+        return result.matched_count == 1
+
+    async def fetch_batch(self, collection, query: dict, limit: int) -> List[dict]:
+        return await collection.find(query).sort("_id", 1).limit(limit).to_list(None)
+
+    async def write_batch(self, migration: Migration, collection, batch: List[dict], outdated: dict) -> bool:
+        """
+        Write the upgraded fields for `batch`. Each update only applies if the
+        document still holds the values it was read with; documents changed
+        in the meantime are read again and retried. Returns False if some
+        documents kept changing.
+        """
+        for _ in range(WRITE_RETRIES):
+            operations = []
+            for doc in batch:
+                fields = upgrade_fields(migration.collection, doc, migration.version)
+                guarded = (set(fields) - {"schema_version"}) | {"updated_at"}
+                unchanged = {
+                    key: doc[key] if key in doc else {"$exists": False}
+                    for key in guarded
+                }
+                operations.append(UpdateOne({"_id": doc["_id"], **outdated, **unchanged}, {"$set": fields}))
+
+            result = await collection.bulk_write(operations, ordered=False)
+            if result.matched_count == len(operations):
+                return True
+            # Documents still outdated were changed between our read and write
+            batch = await collection.find({"_id": {"$in": [doc["_id"] for doc in batch]}, **outdated}).to_list(None)
+            if not batch:
+                return True
+        logger.warning(f"{len(batch)} documents kept changing during {migration.key}")
+        return False
+
+    async def run(self, migration: Migration) -> bool:
+        collection = self.db[migration.collection]
+        if self.dry_run:
+            record = await self.db.migrations.find_one({"_id": migration.key})
+        else:
+            record = await self.acquire(migration)
+            if record is None:
+                logger.info(f"Migration {migration.key} is held by another runner")
+                return False
+        last_id = record["last_id"] if record else None
+        processed = record["processed"] if record else 0
+
+        logger.info(f"{'Dry run of' if self.dry_run else 'Running'} migration {migration.key} ({migration.name})"
+                    + (f", resuming after {last_id}" if last_id is not None else ""))
+
+        # Matches documents below this version, including ones without a schema_version
+        outdated = {"schema_version": {"$not": {"$gte": migration.version}}}
+
+        while True:
+            query = dict(outdated)
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = await self.fetch_batch(collection, query, self.throttle.batch_size)
+            if not batch:
+                break
+            last_id = batch[-1]["_id"]
+            processed += len(batch)
+
+            if self.dry_run:
+                fields = upgrade_fields(migration.collection, batch[0], migration.version)
+                logger.info(f"Would update {len(batch)} documents, e.g. {batch[0]['_id']}: {fields}")
+                continue
+
+            started = time.perf_counter()
+            written = await self.write_batch(migration, collection, batch, outdated)
+            self.throttle.record(time.perf_counter() - started)
+            if not written:
+                # Stop before checkpointing so the next run retries this batch
+                return False
+
+            if not await self.checkpoint(migration, {
+                "last_id": last_id, "processed": processed, "checkpointed_at": datetime.utcnow()
+            }):
+                logger.warning(f"Lost the lease on migration {migration.key}, stopping")
+                return False
+            await self.throttle.wait()
+
+        if not self.dry_run and not await self.checkpoint(migration, {
+            "status": COMPLETED, "processed": processed, "completed_at": datetime.utcnow(), "lease_owner": None
+        }):
+            logger.warning(f"Lost the lease on migration {migration.key} before marking it completed")
+            return False
+        logger.info(f"Migration {migration.key} {'would process' if self.dry_run else 'processed'} {processed} documents")
+        return True
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run pending document migrations")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--target-latency-ms", type=float, default=200.0)
+    args = parser.parse_args()
+
+    load_dotenv(ROOT_DIR / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+
+    throttle = AdaptiveThrottle(args.target_latency_ms / 1000, batch_size=args.batch_size)
+    try:
+        if not await MigrationRunner(db, throttle, dry_run=args.dry_run).run_all():
+            raise SystemExit("Migrations did not finish, see the log for details")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(main())
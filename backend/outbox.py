@@ -0,0 +1,445 @@
+"""
+Transactional outbox for swap side effects.
+
+Request handlers write an event document to the `outbox_events`
+collection together with the swap mutation, in one transaction where the
+deployment supports it (see `write_with_event`). Everything slow (emails,
+analytics, notifications) runs in the worker below, started as its own
+process:
+
+    python outbox.py
+
+Events are only claimed once the batching window they were created in has
+closed, so a consumer sees all of a window's events together. Each
+consumer's success is recorded on the event, so a retry only re-runs the
+consumers that failed. Delivery is still at-least-once: a consumer that
+fails half way through a batch will see those events again.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import smtplib
+import socket
+import uuid
+from collections import defaultdict
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+ROOT_DIR = Path(__file__).parent
+
+logger = logging.getLogger(__name__)
+
+# Event statuses
+PENDING = "pending"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+# Event types
+SWAP_CREATED = "swap.created"
+SWAP_STATUS_CHANGED = "swap.status_changed"
+SWAP_DELETED = "swap.deleted"
+
+
+@dataclass
+class OutboxConfig:
+    batch_size: int = 500
+    poll_interval_seconds: float = 1.0
+    lease_seconds: float = 60.0
+    # Claims, including ones whose lease expired, before an event is failed
+    max_attempts: int = 8
+    backoff_base_seconds: float = 2.0
+    backoff_max_seconds: float = 600.0
+    # Events are held until the window they were created in closes, so that
+    # a user's events within one window end up in a single digest
+    digest_window_seconds: int = 300
+    # Point at a local stand-in such as `python -m aiosmtpd -n -l localhost:1025`
+    smtp_host: str = "localhost"
+    smtp_port: int = 1025
+    smtp_sender: str = "no-reply@skillswap.local"
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            batch_size=int(os.environ.get("OUTBOX_BATCH_SIZE", 500)),
+            poll_interval_seconds=float(os.environ.get("OUTBOX_POLL_INTERVAL", 1.0)),
+            lease_seconds=float(os.environ.get("OUTBOX_LEASE_SECONDS", 60.0)),
+            max_attempts=int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 8)),
+            backoff_base_seconds=float(os.environ.get("OUTBOX_BACKOFF_BASE", 2.0)),
+            backoff_max_seconds=float(os.environ.get("OUTBOX_BACKOFF_MAX", 600.0)),
+            digest_window_seconds=int(os.environ.get("OUTBOX_DIGEST_WINDOW", 300)),
+            smtp_host=os.environ.get("SMTP_HOST", "localhost"),
+            smtp_port=int(os.environ.get("SMTP_PORT", 1025)),
+            smtp_sender=os.environ.get("SMTP_SENDER", "no-reply@skillswap.local"),
+        )
+
+
+def build_swap_event(event_type: str, swap_request: dict, **payload) -> dict:
+    """Build an outbox event for a swap mutation."""
+    now = datetime.utcnow()
+    return {
+        "id": str(uuid.uuid4()),
+        "type": event_type,
+        "swap_id": swap_request["id"],
+        "requester_id": swap_request["requester_id"],
+        "requested_user_id": swap_request["requested_user_id"],
+        "payload": payload,
+        "status": PENDING,
+        "attempts": 0,
+        "done_consumers": [],
+        "digest_sent_to": [],
+        "digest_refused": [],
+        "available_at": now,
+        "claim_token": None,
+        "claimed_at": None,
+        "last_error": None,
+        "created_at": now,
+    }
+
+
+async def record_event(db: AsyncIOMotorDatabase, event: dict, session=None):
+    """Append an event to the outbox. Only one insert on the request path."""
+    await db.outbox_events.insert_one(event, session=session)
+
+
+def supports_transactions(db: AsyncIOMotorDatabase) -> bool:
+    topology = db.client.topology_description.topology_type_name
+    return topology in ("ReplicaSetWithPrimary", "Sharded")
+
+
+async def write_with_event(db: AsyncIOMotorDatabase, write: Callable[[Optional[object]], Awaitable], event: dict):
+    """
+    Run `write(session)` and record `event` atomically.
+
+    Standalone servers have no transactions, so there the event is written
+    right after the mutation and `write` receives no session.
+    """
+    if not supports_transactions(db):
+        await write(None)
+        await record_event(db, event)
+        return
+
+    async def write_both(session):
+        await write(session)
+        await record_event(db, event, session=session)
+
+    async with await db.client.start_session() as session:
+        await session.with_transaction(write_both)
+
+
+async def ensure_outbox_indexes(db: AsyncIOMotorDatabase):
+    await db.outbox_events.create_index("id", unique=True)
+    await db.outbox_events.create_index("claim_token")
+    await db.outbox_events.create_index([("status", 1), ("available_at", 1)])
+    await db.outbox_events.create_index([("status", 1), ("claimed_at", 1)])
+
+
+# Consumers
+#
+# A consumer receives the events of a claimed batch it has not yet handled
+# and returns the ids of the events it failed on. Batching lets consumers
+# coalesce work, e.g. one digest email per user instead of one per event.
+
+Consumer = Callable[[AsyncIOMotorDatabase, List[dict]], Awaitable[List[str]]]
+
+
+def _describe_event(event: dict, user_id: str) -> str:
+    if event["type"] == SWAP_CREATED:
+        if event["requested_user_id"] == user_id:
+            return f"New swap request {event['swap_id']} received"
+        return f"Swap request {event['swap_id']} sent"
+    if event["type"] == SWAP_STATUS_CHANGED:
+        return f"Swap request {event['swap_id']} is now {event['payload'].get('status')}"
+    if event["type"] == SWAP_DELETED:
+        return f"Swap request {event['swap_id']} was withdrawn"
+    return f"{event['type']} on swap {event['swap_id']}"
+
+
+def _is_permanent_refusal(error: smtplib.SMTPException) -> bool:
+    """5xx replies will not succeed on retry."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+class DigestEmailConsumer:
+    """
+    Sends one digest email per affected user for the whole batch.
+
+    Delivery is tracked per recipient on each event (`digest_sent_to`,
+    `digest_refused`), so retrying an event shared by two users only mails
+    the one who has not had it yet.
+    """
+
+    def __init__(self, smtp_host: str, smtp_port: int, sender: str):
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.sender = sender
+
+    def _send_email(self, to_address: str, subject: str, body: str):
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = to_address
+        message["Subject"] = subject
+        message.set_content(body)
+
+        with smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=10) as smtp:
+            smtp.send_message(message)
+
+    async def __call__(self, db: AsyncIOMotorDatabase, events: List[dict]) -> List[str]:
+        events_by_user: Dict[str, List[dict]] = defaultdict(list)
+        for event in events:
+            handled = set(event.get("digest_sent_to", [])) | set(event.get("digest_refused", []))
+            for user_id in (event["requester_id"], event["requested_user_id"]):
+                if user_id not in handled:
+                    events_by_user[user_id].append(event)
+
+        users = await db.users.find(
+            {"id": {"$in": list(events_by_user)}},
+            {"id": 1, "email": 1, "name": 1}
+        ).to_list(None)
+
+        failed = set()
+        for user in users:
+            user_events = events_by_user[user["id"]]
+            lines = [f"- {_describe_event(event, user['id'])}" for event in user_events]
+            body = f"Hi {user['name']},\n\nHere is what happened with your skill swaps:\n\n" + "\n".join(lines)
+
+            try:
+                await asyncio.to_thread(self._send_email, user["email"], "Your SkillSwap digest", body)
+                outcome = "digest_sent_to"
+            except smtplib.SMTPException as e:
+                if not _is_permanent_refusal(e):
+                    logger.warning(f"Digest email to user {user['id']} failed: {e}")
+                    failed.update(event["id"] for event in user_events)
+                    continue
+                logger.warning(f"Digest email to user {user['id']} permanently refused: {e}")
+                outcome = "digest_refused"
+            except OSError as e:
+                logger.warning(f"Digest email to user {user['id']} failed: {e}")
+                failed.update(event["id"] for event in user_events)
+                continue
+
+            await db.outbox_events.update_many(
+                {"id": {"$in": [event["id"] for event in user_events]}},
+                {"$addToSet": {outcome: user["id"]}}
+            )
+
+        return list(failed)
+
+
+def default_consumers(config: OutboxConfig) -> Dict[str, Consumer]:
+    return {
+        "digest_email": DigestEmailConsumer(config.smtp_host, config.smtp_port, config.smtp_sender),
+    }
+
+
+# Worker
+
+class OutboxWorker:
+    def __init__(self, db: AsyncIOMotorDatabase, config: OutboxConfig = None,
+                 consumers: Dict[str, Consumer] = None, worker_id: str = None):
+        self.db = db
+        self.config = config or OutboxConfig()
+        self.consumers = consumers if consumers is not None else default_consumers(self.config)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._stopping = asyncio.Event()
+
+    def backoff_delay(self, attempts: int) -> float:
+        """Exponential backoff for the given number of attempts."""
+        return min(self.config.backoff_base_seconds * (2 ** (attempts - 1)), self.config.backoff_max_seconds)
+
+    def window_start(self, now: datetime) -> datetime:
+        """Start of the batching window `now` falls in; earlier events are claimable."""
+        window = self.config.digest_window_seconds
+        if window <= 0:
+            return now + timedelta(microseconds=1)
+        elapsed = (now - datetime.min).total_seconds()
+        return datetime.min + timedelta(seconds=elapsed - elapsed % window)
+
+    async def fail_expired_leases(self, now: datetime):
+        """Fail events whose worker died on them too many times."""
+        await self.db.outbox_events.update_many(
+            {
+                "status": PROCESSING,
+                "claimed_at": {"$lt": now - timedelta(seconds=self.config.lease_seconds)},
+                "attempts": {"$gte": self.config.max_attempts},
+            },
+            {"$set": {"status": FAILED, "last_error": "lease expired", "claim_token": None}}
+        )
+
+    async def claim_batch(self) -> List[dict]:
+        """Claim up to `batch_size` due events, including expired leases, under one claim token."""
+        now = datetime.utcnow()
+        await self.fail_expired_leases(now)
+
+        query = {
+            "$or": [
+                {"status": PENDING, "available_at": {"$lte": now}},
+                {
+                    "status": PROCESSING,
+                    "claimed_at": {"$lt": now - timedelta(seconds=self.config.lease_seconds)},
+                    "attempts": {"$lt": self.config.max_attempts},
+                },
+            ],
+            "created_at": {"$lt": self.window_start(now)},
+        }
+        candidates = await self.db.outbox_events.find(query, {"id": 1}) \
+            .sort("created_at", 1).limit(self.config.batch_size).to_list(None)
+        if not candidates:
+            return []
+
+        # Re-applying the query keeps events another worker claimed meanwhile out
+        claim_token = str(uuid.uuid4())
+        await self.db.outbox_events.update_many(
+            {"id": {"$in": [event["id"] for event in candidates]}, **query},
+            {
+                "$set": {"status": PROCESSING, "claim_token": claim_token,
+                         "claimed_by": self.worker_id, "claimed_at": now},
+                "$inc": {"attempts": 1},
+            }
+        )
+        return await self.db.outbox_events.find({"claim_token": claim_token}).sort("created_at", 1).to_list(None)
+
+    async def _renew_lease(self, claim_token: str):
+        """Keep `claimed_at` fresh while a batch is processed so it is not reclaimed."""
+        interval = self.config.lease_seconds / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.db.outbox_events.update_many(
+                    {"claim_token": claim_token, "status": PROCESSING},
+                    {"$set": {"claimed_at": datetime.utcnow()}}
+                )
+            except Exception:
+                logger.exception("Renewing outbox lease failed")
+
+    async def process_batch(self, events: List[dict]):
+        if not events:
+            return
+        heartbeat = asyncio.create_task(self._renew_lease(events[0]["claim_token"]))
+        try:
+            await self._process_claimed(events)
+        finally:
+            heartbeat.cancel()
+            with suppress(asyncio.CancelledError):
+                await heartbeat
+
+    async def _process_claimed(self, events: List[dict]):
+        claim_token = events[0]["claim_token"]
+        done_consumers = {event["id"]: set(event["done_consumers"]) for event in events}
+        errors = {}
+
+        for name, consumer in self.consumers.items():
+            todo = [event for event in events if name not in done_consumers[event["id"]]]
+            if not todo:
+                continue
+
+            error = f"{name}: consumer reported failure"
+            try:
+                failed = set(await consumer(self.db, todo))
+            except Exception as e:
+                logger.exception(f"Outbox consumer {name} crashed")
+                failed = {event["id"] for event in todo}
+                error = f"{name}: {e}"
+
+            succeeded = [event["id"] for event in todo if event["id"] not in failed]
+            if succeeded:
+                await self.db.outbox_events.update_many(
+                    {"id": {"$in": succeeded}, "claim_token": claim_token},
+                    {"$addToSet": {"done_consumers": name}}
+                )
+            for event_id in succeeded:
+                done_consumers[event_id].add(name)
+            for event_id in failed:
+                errors[event_id] = error
+
+        done_ids = [event["id"] for event in events if event["id"] not in errors]
+        if done_ids:
+            await self.db.outbox_events.update_many(
+                {"id": {"$in": done_ids}, "claim_token": claim_token},
+                {"$set": {"status": DONE, "claim_token": None, "processed_at": datetime.utcnow()}}
+            )
+
+        for event in events:
+            if event["id"] in errors:
+                await self._retry_or_fail(event, errors[event["id"]])
+
+    async def _retry_or_fail(self, event: dict, error: str):
+        # `attempts` was already incremented when the event was claimed
+        attempts = event["attempts"]
+        if attempts >= self.config.max_attempts:
+            update = {"status": FAILED, "last_error": error, "claim_token": None}
+        else:
+            update = {
+                "status": PENDING,
+                "last_error": error,
+                "available_at": datetime.utcnow() + timedelta(seconds=self.backoff_delay(attempts)),
+                "claim_token": None,
+                "claimed_at": None,
+            }
+        await self.db.outbox_events.update_one(
+            {"id": event["id"], "claim_token": event["claim_token"]},
+            {"$set": update}
+        )
+
+    async def run_once(self) -> int:
+        events = await self.claim_batch()
+        await self.process_batch(events)
+        return len(events)
+
+    async def run(self):
+        logger.info(f"Outbox worker {self.worker_id} started")
+        while not self._stopping.is_set():
+            try:
+                processed = await self.run_once()
+            except Exception:
+                # Transient errors (AutoReconnect, server selection timeouts)
+                # must not kill the worker; unfinished claims are retried
+                # once their lease expires.
+                logger.exception("Outbox poll failed")
+                processed = 0
+            if processed < self.config.batch_size:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.config.poll_interval_seconds)
+                except asyncio.TimeoutError:
+                    pass
+        logger.info(f"Outbox worker {self.worker_id} stopped")
+
+    def stop(self):
+        self._stopping.set()
+
+
+async def main():
+    load_dotenv(ROOT_DIR / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+
+    await ensure_outbox_indexes(db)
+    worker = OutboxWorker(db, OutboxConfig.from_env())
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, worker.stop)
+
+    try:
+        await worker.run()
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(main())
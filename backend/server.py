@@ -1,10 +1,15 @@
-from fastapi import FastAPI, APIRouter, Depends, HTTPException, status
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import ExecutionTimeout
 import os
+import asyncio
 import logging
+import time
+from contextlib import asynccontextmanager, suppress
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional
@@ -13,22 +18,46 @@ from datetime import datetime, timedelta
 import jwt
 import bcrypt
 from enum import Enum
+from outbox import SWAP_CREATED, SWAP_DELETED, SWAP_STATUS_CHANGED, build_swap_event, ensure_outbox_indexes, write_with_event
+from migrations import current_schema_version, normalize_skills, upgrade_document
+from database import DataAccess
 
 ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
-
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
 
 # JWT Configuration
 JWT_SECRET = "your-secret-key-change-in-production"
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
-# Create the main app without a prefix
-app = FastAPI()
+# Settings
+class Settings(BaseModel):
+    mongo_url: str
+    db_name: str
+    # Connections opened concurrently during warm-up
+    mongo_min_pool_size: int = 10
+    mongo_max_pool_size: int = 100
+    mongo_wait_queue_timeout_ms: int = 1000
+    mongo_connect_timeout_ms: int = 5000
+    mongo_server_selection_timeout_ms: int = 5000
+    # Discovery reads (search, public profiles, dashboard counts)
+    # The server rejects maxStalenessSeconds below 90
+    mongo_max_staleness_seconds: int = Field(90, ge=90)
+    mongo_discovery_max_time_ms: int = 2000
+
+    @classmethod
+    def from_env(cls):
+        load_dotenv(ROOT_DIR / '.env')
+        return cls(
+            mongo_url=os.environ['MONGO_URL'],
+            db_name=os.environ['DB_NAME'],
+            mongo_min_pool_size=int(os.environ.get('MONGO_MIN_POOL_SIZE', 10)),
+            mongo_max_pool_size=int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+            mongo_wait_queue_timeout_ms=int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 1000)),
+            mongo_connect_timeout_ms=int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+            mongo_server_selection_timeout_ms=int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+            mongo_max_staleness_seconds=int(os.environ.get('MONGO_MAX_STALENESS_SECONDS', 90)),
+            mongo_discovery_max_time_ms=int(os.environ.get('MONGO_DISCOVERY_MAX_TIME_MS', 2000)),
+        )
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -61,6 +90,7 @@ class User(BaseModel):
     is_profile_public: bool = True
     role: UserRole = UserRole.USER
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 class UserCreate(BaseModel):
     email: str
@@ -101,6 +131,14 @@ class SwapRequestCreate(BaseModel):
 class SwapStatusUpdate(BaseModel):
     status: SwapStatus
 
+# Dependencies
+def get_data(request: Request) -> DataAccess:
+    return request.app.state.data
+
+def get_db(request: Request) -> AsyncIOMotorDatabase:
+    # Primary reads: auth, swap state and read-your-writes
+    return request.app.state.data.primary
+
 # Utility functions
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -115,14 +153,14 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncIOMotorDatabase = Depends(get_db)):
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        user = await db.users.find_one({"id": user_id})
+        user = upgrade_document("users", await db.users.find_one({"id": user_id}))
         if user is None:
             raise HTTPException(status_code=401, detail="User not found")
         
@@ -132,7 +170,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
 
 # Authentication endpoints
 @api_router.post("/auth/register")
-async def register(user_data: UserCreate):
+async def register(user_data: UserCreate, db: AsyncIOMotorDatabase = Depends(get_db)):
     # Check if user already exists
     existing_user = await db.users.find_one({"email": user_data.email})
     if existing_user:
@@ -148,6 +186,7 @@ async def register(user_data: UserCreate):
     # Store user with hashed password
     user_with_password = user.dict()
     user_with_password["password"] = hashed_password
+    user_with_password["schema_version"] = current_schema_version("users")
     
     await db.users.insert_one(user_with_password)
     
@@ -157,9 +196,9 @@ async def register(user_data: UserCreate):
     return {"access_token": access_token, "token_type": "bearer", "user": user}
 
 @api_router.post("/auth/login")
-async def login(user_data: UserLogin):
+async def login(user_data: UserLogin, db: AsyncIOMotorDatabase = Depends(get_db)):
     # Find user
-    user_doc = await db.users.find_one({"email": user_data.email})
+    user_doc = upgrade_document("users", await db.users.find_one({"email": user_data.email}))
     if not user_doc:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
@@ -182,10 +221,14 @@ async def get_current_user_profile(current_user: User = Depends(get_current_user
     return current_user
 
 @api_router.put("/users/me", response_model=User)
-async def update_profile(profile_data: UserProfile, current_user: User = Depends(get_current_user)):
+async def update_profile(profile_data: UserProfile, current_user: User = Depends(get_current_user), db: AsyncIOMotorDatabase = Depends(get_db)):
     # Update user profile
     update_data = profile_data.dict()
+    update_data["skills_offered"] = normalize_skills(update_data["skills_offered"])
+    update_data["skills_wanted"] = normalize_skills(update_data["skills_wanted"])
     update_data["updated_at"] = datetime.utcnow()
+    # Every field the migrations touch is written here, normalized
+    update_data["schema_version"] = current_schema_version("users")
     
     await db.users.update_one(
         {"id": current_user.id},
@@ -193,13 +236,13 @@ async def update_profile(profile_data: UserProfile, current_user: User = Depends
     )
     
     # Return updated user
-    updated_user = await db.users.find_one({"id": current_user.id})
+    updated_user = upgrade_document("users", await db.users.find_one({"id": current_user.id}))
     user_dict = {k: v for k, v in updated_user.items() if k != "password"}
     return User(**user_dict)
 
 # Search and discovery endpoints
 @api_router.get("/users/search")
-async def search_users(skill: Optional[str] = None, location: Optional[str] = None, current_user: User = Depends(get_current_user)):
+async def search_users(skill: Optional[str] = None, location: Optional[str] = None, current_user: User = Depends(get_current_user), data: DataAccess = Depends(get_data)):
     query = {"is_profile_public": True, "id": {"$ne": current_user.id}}
     
     if skill:
@@ -208,12 +251,16 @@ async def search_users(skill: Optional[str] = None, location: Optional[str] = No
     if location:
         query["location"] = {"$regex": location, "$options": "i"}
     
-    users = await db.users.find(query, {"password": 0}).to_list(100)
-    return [User(**user) for user in users]
+    users = await data.discovery.users.find(query, {"password": 0}).max_time_ms(data.discovery_max_time_ms).to_list(100)
+    return [User(**upgrade_document("users", user)) for user in users]
 
 @api_router.get("/users/{user_id}", response_model=User)
-async def get_user_profile(user_id: str, current_user: User = Depends(get_current_user)):
-    user = await db.users.find_one({"id": user_id, "is_profile_public": True}, {"password": 0})
+async def get_user_profile(user_id: str, current_user: User = Depends(get_current_user), data: DataAccess = Depends(get_data)):
+    user = upgrade_document("users", await data.discovery.users.find_one(
+        {"id": user_id, "is_profile_public": True},
+        {"password": 0},
+        max_time_ms=data.discovery_max_time_ms
+    ))
     if not user:
         raise HTTPException(status_code=404, detail="User not found or profile is private")
     
@@ -221,9 +268,9 @@ async def get_user_profile(user_id: str, current_user: User = Depends(get_curren
 
 # Swap request endpoints
 @api_router.post("/swaps", response_model=SwapRequest)
-async def create_swap_request(swap_data: SwapRequestCreate, current_user: User = Depends(get_current_user)):
+async def create_swap_request(swap_data: SwapRequestCreate, current_user: User = Depends(get_current_user), db: AsyncIOMotorDatabase = Depends(get_db)):
     # Check if target user exists and has the requested skill
-    target_user = await db.users.find_one({"id": swap_data.requested_user_id})
+    target_user = upgrade_document("users", await db.users.find_one({"id": swap_data.requested_user_id}))
     if not target_user:
         raise HTTPException(status_code=404, detail="Target user not found")
     
@@ -249,22 +296,27 @@ async def create_swap_request(swap_data: SwapRequestCreate, current_user: User =
         **swap_data.dict()
     )
     
-    await db.swap_requests.insert_one(swap_request.dict())
+    # Side effects (emails, analytics) are handled by the outbox worker
+    await write_with_event(
+        db,
+        lambda session: db.swap_requests.insert_one(swap_request.dict(), session=session),
+        build_swap_event(SWAP_CREATED, swap_request.dict())
+    )
     
     return swap_request
 
 @api_router.get("/swaps/sent", response_model=List[SwapRequest])
-async def get_sent_requests(current_user: User = Depends(get_current_user)):
+async def get_sent_requests(current_user: User = Depends(get_current_user), db: AsyncIOMotorDatabase = Depends(get_db)):
     requests = await db.swap_requests.find({"requester_id": current_user.id}).to_list(100)
     return [SwapRequest(**req) for req in requests]
 
 @api_router.get("/swaps/received", response_model=List[SwapRequest])
-async def get_received_requests(current_user: User = Depends(get_current_user)):
+async def get_received_requests(current_user: User = Depends(get_current_user), db: AsyncIOMotorDatabase = Depends(get_db)):
     requests = await db.swap_requests.find({"requested_user_id": current_user.id}).to_list(100)
     return [SwapRequest(**req) for req in requests]
 
 @api_router.put("/swaps/{swap_id}", response_model=SwapRequest)
-async def update_swap_status(swap_id: str, status_update: SwapStatusUpdate, current_user: User = Depends(get_current_user)):
+async def update_swap_status(swap_id: str, status_update: SwapStatusUpdate, current_user: User = Depends(get_current_user), db: AsyncIOMotorDatabase = Depends(get_db)):
     swap_request = await db.swap_requests.find_one({"id": swap_id})
     if not swap_request:
         raise HTTPException(status_code=404, detail="Swap request not found")
@@ -279,16 +331,23 @@ async def update_swap_status(swap_id: str, status_update: SwapStatusUpdate, curr
         "updated_at": datetime.utcnow()
     }
     
-    await db.swap_requests.update_one(
-        {"id": swap_id},
-        {"$set": update_data}
+    await write_with_event(
+        db,
+        lambda session: db.swap_requests.update_one({"id": swap_id}, {"$set": update_data}, session=session),
+        build_swap_event(
+            SWAP_STATUS_CHANGED,
+            swap_request,
+            status=status_update.status.value,
+            previous_status=swap_request["status"],
+            changed_by=current_user.id
+        )
     )
     
     updated_request = await db.swap_requests.find_one({"id": swap_id})
     return SwapRequest(**updated_request)
 
 @api_router.delete("/swaps/{swap_id}")
-async def delete_swap_request(swap_id: str, current_user: User = Depends(get_current_user)):
+async def delete_swap_request(swap_id: str, current_user: User = Depends(get_current_user), db: AsyncIOMotorDatabase = Depends(get_db)):
     swap_request = await db.swap_requests.find_one({"id": swap_id})
     if not swap_request:
         raise HTTPException(status_code=404, detail="Swap request not found")
@@ -297,21 +356,27 @@ async def delete_swap_request(swap_id: str, current_user: User = Depends(get_cur
     if swap_request["requester_id"] != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized to delete this request")
     
-    await db.swap_requests.delete_one({"id": swap_id})
+    await write_with_event(
+        db,
+        lambda session: db.swap_requests.delete_one({"id": swap_id}, session=session),
+        build_swap_event(SWAP_DELETED, swap_request, status=swap_request["status"])
+    )
     return {"message": "Swap request deleted successfully"}
 
 # Dashboard endpoint
 @api_router.get("/dashboard")
-async def get_dashboard(current_user: User = Depends(get_current_user)):
-    # Get statistics
-    sent_requests = await db.swap_requests.count_documents({"requester_id": current_user.id})
-    received_requests = await db.swap_requests.count_documents({"requested_user_id": current_user.id})
-    pending_sent = await db.swap_requests.count_documents({"requester_id": current_user.id, "status": "pending"})
-    pending_received = await db.swap_requests.count_documents({"requested_user_id": current_user.id, "status": "pending"})
-    active_swaps = await db.swap_requests.count_documents({
+async def get_dashboard(current_user: User = Depends(get_current_user), data: DataAccess = Depends(get_data)):
+    # Get statistics (counts tolerate slight staleness)
+    swap_requests = data.discovery.swap_requests
+    max_time_ms = data.discovery_max_time_ms
+    sent_requests = await swap_requests.count_documents({"requester_id": current_user.id}, maxTimeMS=max_time_ms)
+    received_requests = await swap_requests.count_documents({"requested_user_id": current_user.id}, maxTimeMS=max_time_ms)
+    pending_sent = await swap_requests.count_documents({"requester_id": current_user.id, "status": "pending"}, maxTimeMS=max_time_ms)
+    pending_received = await swap_requests.count_documents({"requested_user_id": current_user.id, "status": "pending"}, maxTimeMS=max_time_ms)
+    active_swaps = await swap_requests.count_documents({
         "$or": [{"requester_id": current_user.id}, {"requested_user_id": current_user.id}],
         "status": "accepted"
-    })
+    }, maxTimeMS=max_time_ms)
     
     return {
         "user": current_user,
@@ -324,16 +389,19 @@ async def get_dashboard(current_user: User = Depends(get_current_user)):
         }
     }
 
-# Include the router in the main app
-app.include_router(api_router)
+# Health endpoints
+@api_router.get("/health/ready")
+async def readiness(request: Request):
+    if not getattr(request.app.state, "ready", False):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Warming up")
+    return {"status": "ready", "warmup_seconds": request.app.state.warmup_seconds}
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+@api_router.get("/metrics/pool")
+async def pool_metrics(current_user: User = Depends(get_current_user), data: DataAccess = Depends(get_data)):
+    # Exposes internal Mongo addresses, so admins only
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return {"pool_wait": data.pool_monitor.snapshot()}
 
 # Configure logging
 logging.basicConfig(
@@ -342,6 +410,80 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# Startup
+async def warm_connection_pool(db: AsyncIOMotorDatabase, connections: int):
+    # Concurrent pings force the driver to open that many pooled connections
+    await asyncio.gather(*(db.command("ping") for _ in range(connections)))
+
+async def create_indexes(db: AsyncIOMotorDatabase):
+    await asyncio.gather(
+        db.users.create_index("id"),
+        db.users.create_index("email"),
+        db.swap_requests.create_index("id"),
+        db.swap_requests.create_index([("requester_id", 1), ("status", 1)]),
+        db.swap_requests.create_index([("requested_user_id", 1), ("status", 1)]),
+        ensure_outbox_indexes(db),
+    )
+
+async def warm_up(app: FastAPI, data: DataAccess, settings: Settings):
+    started = time.perf_counter()
+    while True:
+        try:
+            await asyncio.gather(
+                warm_connection_pool(data.primary, settings.mongo_min_pool_size),
+                create_indexes(data.primary),
+            )
+            break
+        except Exception:
+            logger.exception("Startup warm-up failed, retrying")
+            await asyncio.sleep(1)
+
+    app.state.warmup_seconds = round(time.perf_counter() - started, 4)
+    app.state.ready = True
+    logger.info(f"Startup warm-up finished in {app.state.warmup_seconds}s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings = app.state.settings = app.state.settings or Settings.from_env()
+    data = app.state.data = DataAccess(settings)
+    # Warm up in the background so the server listens, and readiness
+    # reports 503, until the pool and indexes are in place
+    warmup = asyncio.create_task(warm_up(app, data, settings))
+    try:
+        yield
+    finally:
+        app.state.ready = False
+        warmup.cancel()
+        with suppress(asyncio.CancelledError):
+            await warmup
+        data.close()
+
+async def execution_timeout_handler(request: Request, exc: ExecutionTimeout):
+    # Raised when a read exceeds its maxTimeMS, e.g. slow discovery queries
+    logger.warning(f"Query exceeded maxTimeMS on {request.url.path}: {exc}")
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "The database took too long to respond, please try again"},
+        headers={"Retry-After": "1"},
+    )
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    """Build the application. Settings are read from the environment at startup if not given."""
+    app = FastAPI(lifespan=lifespan)
+    app.state.settings = settings
+    app.state.ready = False
+
+    app.include_router(api_router)
+    app.add_exception_handler(ExecutionTimeout, execution_timeout_handler)
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    return app
+
+app = create_app()
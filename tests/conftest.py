@@ -0,0 +1,28 @@
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+
+@pytest_asyncio.fixture
+async def db():
+    """A throwaway database: a real server if MONGO_TEST_URL is set, otherwise mongomock."""
+    mongo_url = os.environ.get("MONGO_TEST_URL")
+    if mongo_url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=2000)
+        name = f"test_{uuid.uuid4().hex[:12]}"
+        try:
+            yield client[name]
+        finally:
+            await client.drop_database(name)
+            client.close()
+    else:
+        mongomock_motor = pytest.importorskip("mongomock_motor")
+        yield mongomock_motor.AsyncMongoMockClient()["test"]
@@ -0,0 +1,77 @@
+import os
+import time
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionCheckedOutEvent, ConnectionCheckOutFailedEvent
+from pymongo.read_preferences import Nearest, Primary
+
+import server
+from database import DataAccess, PoolWaitMonitor
+
+MONGO_RS_URL = os.environ.get("MONGO_RS_URL")
+
+
+def make_settings(mongo_url="mongodb://127.0.0.1:1", **overrides):
+    return server.Settings(mongo_url=mongo_url, db_name=f"test_{uuid.uuid4().hex[:12]}", **overrides)
+
+
+def test_reads_are_routed_by_staleness_tolerance():
+    data = DataAccess(make_settings(mongo_max_staleness_seconds=120))
+    try:
+        assert data.primary.read_preference == Primary()
+        assert data.discovery.read_preference == Nearest(max_staleness=120)
+    finally:
+        data.close()
+
+
+def test_max_staleness_below_server_minimum_is_rejected():
+    with pytest.raises(ValidationError):
+        make_settings(mongo_max_staleness_seconds=30)
+
+
+def test_pool_monitor_uses_driver_durations():
+    monitor = PoolWaitMonitor()
+    address = ("db1", 27017)
+    monitor.connection_checked_out(ConnectionCheckedOutEvent(address, 1, 0.002))
+    monitor.connection_checked_out(ConnectionCheckedOutEvent(address, 2, 0.004))
+    monitor.connection_check_out_failed(ConnectionCheckOutFailedEvent(address, "timeout", 1.0))
+
+    stats = monitor.snapshot()["db1:27017"]
+    assert stats["checkouts"] == 3
+    assert stats["failed"] == 1
+    assert stats["max_ms"] == 1000.0
+    assert stats["total_ms"] == 1006.0
+
+
+@pytest.mark.skipif(not MONGO_RS_URL, reason="MONGO_RS_URL not set")
+def test_pool_metrics_against_replica_set():
+    settings = make_settings(MONGO_RS_URL, mongo_min_pool_size=2)
+    sync_client = MongoClient(MONGO_RS_URL)
+    try:
+        with TestClient(server.create_app(settings)) as client:
+            deadline = time.monotonic() + 30
+            while client.get("/api/health/ready").status_code != 200:
+                assert time.monotonic() < deadline
+                time.sleep(0.1)
+
+            data = client.app.state.data
+            assert data.client.topology_description.topology_type_name == "ReplicaSetWithPrimary"
+
+            response = client.post("/api/auth/register", json={
+                "email": "admin@example.com", "password": "secret", "name": "Admin"
+            })
+            headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+            assert client.get("/api/metrics/pool", headers=headers).status_code == 403
+
+            sync_client[settings.db_name].users.update_one({"email": "admin@example.com"}, {"$set": {"role": "admin"}})
+            assert client.get("/api/users/search", headers=headers).status_code == 200
+
+            pool_wait = client.get("/api/metrics/pool", headers=headers).json()["pool_wait"]
+            assert sum(stats["checkouts"] for stats in pool_wait.values()) > 0
+    finally:
+        sync_client.drop_database(settings.db_name)
+        sync_client.close()
@@ -0,0 +1,190 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from migrations import (
+    COMPLETED, MIGRATIONS, RUNNING, AdaptiveThrottle, MigrationRunner,
+    current_schema_version, normalize_skills, upgrade_document,
+)
+
+CREATED_AT = datetime(2024, 1, 1)
+
+
+def user_doc(name, version=None, **fields):
+    doc = {
+        "id": name,
+        "created_at": CREATED_AT,
+        "skills_offered": [" Python", "python ", "Go"],
+        "skills_wanted": ["", "Rust"],
+        **fields,
+    }
+    if version is not None:
+        doc["schema_version"] = version
+    return doc
+
+
+def make_runner(db, **kwargs):
+    return MigrationRunner(db, AdaptiveThrottle(1.0, batch_size=2, min_batch_size=1), **kwargs)
+
+
+def test_normalize_skills():
+    assert normalize_skills([" Python", "python ", "", "Go"]) == ["Python", "Go"]
+    assert normalize_skills(None) == []
+
+
+def test_current_schema_version():
+    assert current_schema_version("users") == 2
+    assert current_schema_version("swap_requests") == 0
+
+
+@pytest.mark.parametrize("version", [None, 0, 1, 2])
+def test_upgrade_document_handles_mixed_versions(version):
+    updated_at = datetime(2024, 6, 1)
+    doc = user_doc("alice", version, updated_at=updated_at) if version else user_doc("alice", version)
+    if version == 2:
+        doc.update(skills_offered=["Python", "Go"], skills_wanted=["Rust"])
+
+    upgraded = upgrade_document("users", doc)
+
+    assert upgraded["schema_version"] == 2
+    assert upgraded["skills_offered"] == ["Python", "Go"]
+    assert upgraded["skills_wanted"] == ["Rust"]
+    assert upgraded["updated_at"] == (updated_at if version else CREATED_AT)
+
+
+def test_upgrade_document_passes_none_through():
+    assert upgrade_document("users", None) is None
+
+
+def test_throttle_backs_off_when_slow_and_recovers_when_fast():
+    throttle = AdaptiveThrottle(0.1, batch_size=100, min_batch_size=10)
+
+    throttle.record(0.5)
+    assert throttle.batch_size == 50
+    assert throttle.pause_seconds == 0.5
+
+    throttle.record(0.05)
+    assert throttle.batch_size == 60
+    assert throttle.pause_seconds == 0.25
+
+    for _ in range(10):
+        throttle.record(1.0)
+    assert throttle.batch_size == 10
+    assert throttle.pause_seconds == throttle.max_pause_seconds
+
+
+@pytest.mark.asyncio
+async def test_runner_upgrades_documents_of_every_version(db):
+    # carol was written at v0 by an old pod after the v1 migration finished
+    await db.users.insert_many([
+        user_doc("alice"),
+        user_doc("bob", 1, updated_at=datetime(2024, 6, 1)),
+        user_doc("carol", 0),
+    ])
+    await db.migrations.insert_one({"_id": MIGRATIONS[0].key, "status": COMPLETED})
+
+    assert await make_runner(db).run_all()
+
+    async for doc in db.users.find():
+        assert doc["schema_version"] == 2
+        assert doc["skills_offered"] == ["Python", "Go"]
+        assert "updated_at" in doc
+    carol = await db.users.find_one({"id": "carol"})
+    assert carol["updated_at"] == CREATED_AT
+    assert await db.migrations.count_documents({"status": COMPLETED}) == 2
+
+
+@pytest.mark.asyncio
+async def test_runner_resumes_from_checkpoint(db):
+    await db.users.insert_many([user_doc(name, 1, updated_at=CREATED_AT) for name in ("a", "b", "c", "d")])
+    docs = await db.users.find().sort("_id", 1).to_list(None)
+    await db.migrations.insert_many([
+        {"_id": MIGRATIONS[0].key, "status": COMPLETED},
+        {
+            "_id": MIGRATIONS[1].key, "status": RUNNING, "last_id": docs[1]["_id"], "processed": 2,
+            "lease_owner": "crashed-runner", "lease_expires_at": datetime.utcnow() - timedelta(seconds=1),
+        },
+    ])
+
+    assert await make_runner(db).run_all()
+
+    versions = [doc.get("schema_version") for doc in await db.users.find().sort("_id", 1).to_list(None)]
+    assert versions == [1, 1, 2, 2]
+    record = await db.migrations.find_one({"_id": MIGRATIONS[1].key})
+    assert record["status"] == COMPLETED
+    assert record["processed"] == 4
+
+
+@pytest.mark.asyncio
+async def test_dry_run_makes_no_writes(db):
+    await db.users.insert_many([user_doc("alice"), user_doc("bob")])
+    before = await db.users.find().to_list(None)
+
+    assert await make_runner(db, dry_run=True).run_all()
+
+    assert await db.users.find().to_list(None) == before
+    assert await db.migrations.count_documents({}) == 0
+
+
+@pytest.mark.asyncio
+async def test_second_runner_backs_off_while_lease_is_held(db):
+    await db.users.insert_one(user_doc("alice"))
+    first = make_runner(db)
+    assert await first.acquire(MIGRATIONS[0]) is not None
+
+    second = make_runner(db)
+    assert await second.run_all() is False
+    assert (await db.users.find_one({"id": "alice"})).get("schema_version") is None
+
+
+class RacingRunner(MigrationRunner):
+    """Applies `edit` to the collection right after the first batch is read."""
+
+    def __init__(self, db, edit, **kwargs):
+        super().__init__(db, AdaptiveThrottle(1.0, batch_size=10), **kwargs)
+        self.edit = edit
+
+    async def fetch_batch(self, collection, query, limit):
+        batch = await super().fetch_batch(collection, query, limit)
+        if self.edit:
+            await collection.update_one({"id": "alice"}, {"$set": self.edit})
+            self.edit = None
+        return batch
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("schema_version", [None, 2])
+async def test_edit_between_read_and_write_is_not_lost(db, schema_version):
+    await db.users.insert_many([
+        user_doc("alice", 1, updated_at=CREATED_AT, skills_offered=["Old"]),
+        user_doc("bob", 1, updated_at=CREATED_AT),
+    ])
+    await db.migrations.insert_one({"_id": MIGRATIONS[0].key, "status": COMPLETED})
+    edit = {"skills_offered": ["New"], "updated_at": datetime(2024, 6, 1)}
+    if schema_version:
+        edit["schema_version"] = schema_version
+
+    assert await RacingRunner(db, edit).run_all()
+
+    alice = await db.users.find_one({"id": "alice"})
+    assert alice["skills_offered"] == ["New"]
+    assert alice["schema_version"] == 2
+    bob = await db.users.find_one({"id": "bob"})
+    assert bob["skills_offered"] == ["Python", "Go"]
+
+
+class LeaseStealingRunner(MigrationRunner):
+    async def checkpoint(self, migration, fields):
+        if fields.get("status") == COMPLETED:
+            await self.db.migrations.update_one({"_id": migration.key}, {"$set": {"lease_owner": "other"}})
+        return await super().checkpoint(migration, fields)
+
+
+@pytest.mark.asyncio
+async def test_losing_the_lease_before_completion_is_reported(db):
+    await db.users.insert_one(user_doc("alice"))
+    runner = LeaseStealingRunner(db, AdaptiveThrottle(1.0))
+
+    assert await runner.run(MIGRATIONS[0]) is False
+    record = await db.migrations.find_one({"_id": MIGRATIONS[0].key})
+    assert record["status"] == RUNNING
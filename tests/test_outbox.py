@@ -0,0 +1,275 @@
+import asyncio
+import os
+import socket
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+import outbox
+from outbox import (
+    DONE, FAILED, PENDING, PROCESSING, SWAP_CREATED, SWAP_STATUS_CHANGED,
+    OutboxConfig, OutboxWorker, build_swap_event, write_with_event,
+)
+
+aiosmtpd_controller = pytest.importorskip("aiosmtpd.controller")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class CollectingHandler:
+    def __init__(self):
+        self.messages = []
+        # address -> list of replies to give before accepting it
+        self.rcpt_replies = {}
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        replies = self.rcpt_replies.get(address)
+        if replies:
+            return replies.pop(0)
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return "250 Message accepted for delivery"
+
+
+@pytest.fixture
+def smtp_server():
+    handler = CollectingHandler()
+    controller = aiosmtpd_controller.Controller(handler, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    try:
+        yield controller, handler
+    finally:
+        controller.stop()
+
+
+@pytest_asyncio.fixture
+async def users(db):
+    docs = [
+        {"id": name, "email": f"{name}@example.com", "name": name.title()}
+        for name in ("alice", "bob", "carol")
+    ]
+    await db.users.insert_many(docs)
+    return docs
+
+
+def make_config(smtp_port, **overrides):
+    options = dict(
+        smtp_host="127.0.0.1", smtp_port=smtp_port, digest_window_seconds=60,
+        backoff_base_seconds=2.0, max_attempts=3,
+    )
+    options.update(overrides)
+    return OutboxConfig(**options)
+
+
+async def add_event(db, event_type, requester, requested, age_seconds=120, **payload):
+    swap = {"id": f"{requester}-{requested}", "requester_id": requester, "requested_user_id": requested}
+    event = build_swap_event(event_type, swap, **payload)
+    event["created_at"] -= timedelta(seconds=age_seconds)
+    event["available_at"] = event["created_at"]
+    await db.outbox_events.insert_one(event)
+    return event
+
+
+@pytest.mark.asyncio
+async def test_one_digest_per_user_per_batch(db, users, smtp_server):
+    controller, handler = smtp_server
+    await add_event(db, SWAP_CREATED, "alice", "bob")
+    await add_event(db, SWAP_STATUS_CHANGED, "alice", "bob", status="accepted")
+    await add_event(db, SWAP_CREATED, "carol", "bob")
+
+    worker = OutboxWorker(db, make_config(controller.port))
+    assert await worker.run_once() == 3
+
+    recipients = sorted(rcpt for message in handler.messages for rcpt in message.rcpt_tos)
+    assert recipients == ["alice@example.com", "bob@example.com", "carol@example.com"]
+
+    bob_digest = next(m for m in handler.messages if m.rcpt_tos == ["bob@example.com"])
+    assert bob_digest.content.decode().count("\n- ") == 3
+
+    statuses = await db.outbox_events.distinct("status")
+    assert statuses == [DONE]
+
+
+@pytest.mark.asyncio
+async def test_events_wait_for_their_window_to_close(db, users, smtp_server):
+    controller, handler = smtp_server
+    await add_event(db, SWAP_CREATED, "alice", "bob", age_seconds=0)
+
+    worker = OutboxWorker(db, make_config(controller.port, digest_window_seconds=3600))
+    assert await worker.run_once() == 0
+    assert handler.messages == []
+
+
+@pytest.mark.asyncio
+async def test_failed_send_backs_off(db, users):
+    event = await add_event(db, SWAP_CREATED, "alice", "bob")
+
+    worker = OutboxWorker(db, make_config(free_port()))
+    before = datetime.utcnow()
+    await worker.run_once()
+
+    stored = await db.outbox_events.find_one({"id": event["id"]})
+    assert stored["status"] == PENDING
+    assert stored["attempts"] == 1
+    assert stored["available_at"] >= before + timedelta(seconds=2)
+    assert stored["last_error"].startswith("digest_email")
+
+
+@pytest.mark.asyncio
+async def test_event_fails_after_max_attempts(db, users):
+    event = await add_event(db, SWAP_CREATED, "alice", "bob")
+
+    worker = OutboxWorker(db, make_config(free_port(), backoff_base_seconds=0, max_attempts=3))
+    for _ in range(3):
+        await worker.run_once()
+
+    stored = await db.outbox_events.find_one({"id": event["id"]})
+    assert stored["status"] == FAILED
+    assert stored["attempts"] == 3
+    assert await worker.run_once() == 0
+
+
+@pytest.mark.asyncio
+async def test_retry_only_reruns_failed_consumers(db, users):
+    event = await add_event(db, SWAP_CREATED, "alice", "bob")
+    calls = {"digest": 0, "analytics": 0}
+
+    async def digest(db, events):
+        calls["digest"] += 1
+        return []
+
+    async def analytics(db, events):
+        calls["analytics"] += 1
+        return [e["id"] for e in events] if calls["analytics"] == 1 else []
+
+    worker = OutboxWorker(db, make_config(0, backoff_base_seconds=0),
+                          consumers={"digest": digest, "analytics": analytics})
+    await worker.run_once()
+    await worker.run_once()
+
+    stored = await db.outbox_events.find_one({"id": event["id"]})
+    assert stored["status"] == DONE
+    assert sorted(stored["done_consumers"]) == ["analytics", "digest"]
+    assert calls == {"digest": 1, "analytics": 2}
+
+
+@pytest.mark.asyncio
+async def test_expired_lease_counts_as_attempt(db, users):
+    event = await add_event(db, SWAP_CREATED, "alice", "bob")
+    config = make_config(0, lease_seconds=30, max_attempts=2)
+    await db.outbox_events.update_one(
+        {"id": event["id"]},
+        {"$set": {"status": PROCESSING, "attempts": 2, "claimed_at": datetime.utcnow() - timedelta(seconds=60)}}
+    )
+
+    worker = OutboxWorker(db, config, consumers={})
+    assert await worker.run_once() == 0
+
+    stored = await db.outbox_events.find_one({"id": event["id"]})
+    assert stored["status"] == FAILED
+    assert stored["last_error"] == "lease expired"
+
+
+def recipients(handler):
+    return sorted(rcpt for message in handler.messages for rcpt in message.rcpt_tos)
+
+
+@pytest.mark.asyncio
+async def test_retry_only_mails_recipients_still_owed_a_digest(db, users, smtp_server):
+    controller, handler = smtp_server
+    handler.rcpt_replies["bob@example.com"] = ["451 Try again later"]
+    event = await add_event(db, SWAP_CREATED, "alice", "bob")
+
+    worker = OutboxWorker(db, make_config(controller.port, backoff_base_seconds=0))
+    await worker.run_once()
+    assert recipients(handler) == ["alice@example.com"]
+    assert (await db.outbox_events.find_one({"id": event["id"]}))["status"] == PENDING
+
+    await worker.run_once()
+    assert recipients(handler) == ["alice@example.com", "bob@example.com"]
+    stored = await db.outbox_events.find_one({"id": event["id"]})
+    assert stored["status"] == DONE
+    assert sorted(stored["digest_sent_to"]) == ["alice", "bob"]
+
+
+@pytest.mark.asyncio
+async def test_permanent_refusal_is_not_retried(db, users, smtp_server):
+    controller, handler = smtp_server
+    handler.rcpt_replies["bob@example.com"] = ["550 No such user"]
+    event = await add_event(db, SWAP_CREATED, "alice", "bob")
+
+    worker = OutboxWorker(db, make_config(controller.port))
+    await worker.run_once()
+
+    stored = await db.outbox_events.find_one({"id": event["id"]})
+    assert stored["status"] == DONE
+    assert stored["digest_sent_to"] == ["alice"]
+    assert stored["digest_refused"] == ["bob"]
+    assert recipients(handler) == ["alice@example.com"]
+
+
+@pytest.mark.asyncio
+async def test_lease_is_renewed_while_a_batch_is_processed(db, users):
+    event = await add_event(db, SWAP_CREATED, "alice", "bob")
+    seen = {}
+
+    async def slow_consumer(db, events):
+        seen["claimed_at"] = events[0]["claimed_at"]
+        await asyncio.sleep(0.5)
+        seen["renewed_at"] = (await db.outbox_events.find_one({"id": event["id"]}))["claimed_at"]
+        return []
+
+    worker = OutboxWorker(db, make_config(0, lease_seconds=0.3), consumers={"slow": slow_consumer})
+    await worker.run_once()
+
+    assert seen["renewed_at"] > seen["claimed_at"]
+
+
+@pytest.mark.asyncio
+async def test_write_with_event_falls_back_to_sequential_writes(db, monkeypatch):
+    monkeypatch.setattr(outbox, "supports_transactions", lambda db: False)
+    swap = {"id": "s1", "requester_id": "alice", "requested_user_id": "bob"}
+    sessions = []
+
+    async def write(session):
+        sessions.append(session)
+        await db.swap_requests.insert_one(dict(swap), session=session)
+
+    await write_with_event(db, write, build_swap_event(SWAP_CREATED, swap))
+
+    assert sessions == [None]
+    assert await db.swap_requests.count_documents({}) == 1
+    assert await db.outbox_events.count_documents({"swap_id": "s1"}) == 1
+
+
+@pytest.mark.skipif(not os.environ.get("MONGO_RS_URL"), reason="MONGO_RS_URL not set")
+@pytest.mark.asyncio
+async def test_write_with_event_is_atomic_on_a_replica_set():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(os.environ["MONGO_RS_URL"])
+    db = client["test_outbox_txn"]
+    swap = {"id": "s1", "requester_id": "alice", "requested_user_id": "bob"}
+    try:
+        await db.command("ping")
+        assert outbox.supports_transactions(db)
+
+        async def failing_write(session):
+            await db.swap_requests.insert_one(dict(swap), session=session)
+            raise RuntimeError("boom")
+
+        with pytest.raises(RuntimeError):
+            await write_with_event(db, failing_write, build_swap_event(SWAP_CREATED, swap))
+        assert await db.swap_requests.count_documents({}) == 0
+        assert await db.outbox_events.count_documents({}) == 0
+    finally:
+        await client.drop_database("test_outbox_txn")
+        client.close()
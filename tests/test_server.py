@@ -0,0 +1,59 @@
+import importlib
+import os
+import sys
+import time
+
+import pytest
+
+from fastapi.testclient import TestClient
+
+import server
+
+
+def test_import_needs_no_config(monkeypatch):
+    monkeypatch.delenv("MONGO_URL", raising=False)
+    monkeypatch.delenv("DB_NAME", raising=False)
+    sys.modules.pop("server")
+    try:
+        module = importlib.import_module("server")
+    finally:
+        sys.modules["server"] = server
+    assert "MONGO_URL" not in os.environ
+    assert module.app.state.settings is None
+
+
+def test_readiness_reports_warming_up_until_warm_up_finishes():
+    # Nothing listens on port 1, so warm-up keeps retrying
+    settings = server.Settings(
+        mongo_url="mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=100",
+        db_name="test",
+    )
+    with TestClient(server.create_app(settings)) as client:
+        response = client.get("/api/health/ready")
+        assert response.status_code == 503
+        assert response.json()["detail"] == "Warming up"
+
+
+@pytest.mark.skipif(not os.environ.get("MONGO_TEST_URL"), reason="MONGO_TEST_URL not set")
+def test_readiness_flips_after_warm_up():
+    settings = server.Settings(mongo_url=os.environ["MONGO_TEST_URL"], db_name="test_readiness", mongo_min_pool_size=2)
+    with TestClient(server.create_app(settings)) as client:
+        deadline = time.monotonic() + 10
+        while client.get("/api/health/ready").status_code != 200:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+
+def test_query_timeouts_return_503():
+    from pymongo.errors import ExecutionTimeout
+
+    app = server.create_app(server.Settings(mongo_url="mongodb://127.0.0.1:1", db_name="test"))
+
+    @app.get("/slow")
+    async def slow():
+        raise ExecutionTimeout("operation exceeded time limit", code=50)
+
+    response = TestClient(app).get("/slow")
+    assert response.status_code == 503
+    assert response.json()["detail"] == "The database took too long to respond, please try again"
+    assert response.headers["Retry-After"] == "1"